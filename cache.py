@@ -0,0 +1,108 @@
+"""
+Cache Helper Functions
+
+Optional Redis read-through cache for hot read paths. Caching is enabled
+only when REDIS_URL is set; otherwise every lookup is a miss and every
+write/invalidation is a no-op, so callers never need to check.
+
+Key scheme and TTLs:
+    room:{code}                  ROOM_TTL
+    room_state:{code}            ROOM_TTL   (room without confusion_events)
+    guide:{gid}                  GUIDE_TTL
+    guides:search:{digest}       GUIDE_SEARCH_TTL
+
+Every mutation of a cached entity must invalidate its key in the same
+handler; TTLs only bound staleness for writes that bypass the API.
+"""
+
+import hashlib
+import os
+from typing import Any, List, Optional
+
+import orjson
+import redis
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+ROOM_TTL = 300
+GUIDE_TTL = 300
+GUIDE_SEARCH_TTL = 120
+
+GUIDE_SEARCH_PATTERN = "guides:search:*"
+
+_redis = None
+
+redis_url = os.getenv("REDIS_URL")
+
+# Short socket timeouts so a hung Redis fails fast instead of pinning
+# request threads; timeouts surface as RedisError and count as misses
+if redis_url:
+    _redis = redis.Redis.from_url(redis_url, socket_timeout=0.1, socket_connect_timeout=0.2)
+
+def room_key(code: str, include_events: bool = True) -> str:
+    # separate prefixes: codes are arbitrary strings, so a suffix could collide
+    return f"room:{code}" if include_events else f"room_state:{code}"
+
+def room_keys(code: str) -> List[str]:
+    """Every cached view of a room, for invalidation"""
+    return [room_key(code), room_key(code, include_events=False)]
+
+def guide_key(gid: str) -> str:
+    return f"guide:{gid}"
+
+def guide_search_key(q: Optional[str], subject: Optional[str], tag: Optional[str]) -> str:
+    digest = hashlib.sha1(orjson.dumps([q, subject, tag])).hexdigest()
+    return f"guides:search:{digest}"
+
+# Redis errors are swallowed: a cache outage degrades to plain Mongo reads
+def cache_get(key: str) -> Optional[Any]:
+    """Return the cached value for key, or None on miss"""
+    if _redis is None:
+        return None
+    try:
+        raw = _redis.get(key)
+    except redis.RedisError:
+        return None
+    if raw is None:
+        return None
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        # a corrupt entry is a miss; the caller's cache_set overwrites it
+        return None
+
+def cache_set(key: str, value: Any, ttl: int):
+    """Store a JSON-serializable value under key for ttl seconds"""
+    if _redis is None:
+        return
+    try:
+        _redis.set(key, orjson.dumps(value), ex=ttl)
+    except redis.RedisError:
+        pass
+
+def cache_delete(*keys: str):
+    """Invalidate the given keys"""
+    if _redis is None or not keys:
+        return
+    try:
+        _redis.delete(*keys)
+    except redis.RedisError:
+        pass
+
+def cache_delete_pattern(pattern: str):
+    """Invalidate every key matching pattern, using SCAN rather than KEYS"""
+    if _redis is None:
+        return
+    try:
+        batch = []
+        for key in _redis.scan_iter(match=pattern, count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                _redis.delete(*batch)
+                batch = []
+        if batch:
+            _redis.delete(*batch)
+    except redis.RedisError:
+        pass
@@ -9,7 +9,7 @@ from pymongo import MongoClient
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
-from typing import Union
+from typing import List, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
@@ -21,8 +21,31 @@ db = None
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
+# Sync route handlers run on FastAPI's worker threads; main.py sizes that
+# threadpool to this value so every in-flight request can hold a connection
+max_pool_size = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+
+# Per-query server-side time budget (maxTimeMS) for reads issued by the API
+QUERY_TIMEOUT_MS = int(os.getenv("QUERY_TIMEOUT_MS", "500"))
+
+# Driver tuning for many small requests. w=1 acknowledges on the primary only;
+# set MONGO_WRITE_CONCERN=majority where writes must survive a failover.
+# zstd wire compression needs the zstandard package (see requirements.txt).
+# Cached reads are invalidated on write; see cache.py for keys and TTLs.
+write_concern = os.getenv("MONGO_WRITE_CONCERN", "1")
+
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    _client = MongoClient(
+        database_url,
+        maxPoolSize=max_pool_size,
+        minPoolSize=5,
+        waitQueueTimeoutMS=2000,
+        serverSelectionTimeoutMS=3000,
+        retryWrites=True,
+        compressors="zstd",
+        w=int(write_concern) if write_concern.isdigit() else write_concern,
+        readPreference="primaryPreferred",
+    )
     db = _client[database_name]
 
 # Helper functions for common database operations
@@ -43,6 +66,22 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     result = db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
+def create_documents(collection_name: str, items: List[Union[BaseModel, dict]]):
+    """Insert many documents with timestamps in a single round trip"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    docs = []
+    for data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data.copy()
+        data_dict['created_at'] = now
+        data_dict['updated_at'] = now
+        docs.append(data_dict)
+
+    result = db[collection_name].insert_many(docs, ordered=False)
+    return [str(i) for i in result.inserted_ids]
+
 def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
@@ -1,19 +1,40 @@
+import logging
 import os
+import re
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta, timezone
-from typing import List, Optional
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple
 
+import numpy as np
+from anyio import to_thread
+from bson import ObjectId
+from bson.errors import InvalidId
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
 from pydantic import BaseModel
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, ExecutionTimeout, PyMongoError
 
-from database import db, create_document, get_documents
+from cache import (
+    cache_get, cache_set, cache_delete, cache_delete_pattern,
+    room_key, room_keys, guide_key, guide_search_key,
+    ROOM_TTL, GUIDE_TTL, GUIDE_SEARCH_TTL, GUIDE_SEARCH_PATTERN,
+)
+from database import db, create_document, create_documents, get_documents, max_pool_size, QUERY_TIMEOUT_MS
+from migrate import GUIDE_VERSION_UNIQUE_INDEX
 from schemas import (
     Room, Participant, Question, Poll, Note,
     StudyGuide, StudyGuideVersion, Collection,
     Event, Task, Preference, SuggestionRequest, Suggestion
 )
 
-app = FastAPI()
+# orjson encodes datetimes natively; list endpoints also return
+# ORJSONResponse directly to skip FastAPI's jsonable_encoder pass
+app = FastAPI(default_response_class=ORJSONResponse)
+
+logger = logging.getLogger(__name__)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,6 +44,65 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def _oid(value: str) -> ObjectId:
+    try:
+        return ObjectId(value)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid id")
+
+@app.exception_handler(ExecutionTimeout)
+async def query_timeout_handler(request, exc):
+    return JSONResponse(status_code=504, content={"detail": "Database query timed out"})
+
+@app.on_event("startup")
+async def size_threadpool():
+    # handlers are sync and run on anyio worker threads; match the Mongo pool
+    # so concurrency is bounded by connections rather than by the default 40 threads
+    to_thread.current_default_thread_limiter().total_tokens = max_pool_size
+
+def _create_index(collection: str, keys, **kwargs):
+    # index builds are best-effort: an unreachable database, a missing
+    # createIndex privilege or data that violates a unique index must not
+    # stop the app from booting (/test reports database status)
+    try:
+        db[collection].create_index(keys, **kwargs)
+    except PyMongoError as e:
+        logger.warning("Could not create index %s on %s: %s", keys, collection, e)
+
+@app.on_event("startup")
+def ensure_indexes():
+    if db is None:
+        return
+    _create_index("room", "code", unique=True)
+    _create_index("question", [("room_code", 1), ("created_at", -1)])
+    # every note has user_id, so the index covers all notes; a missing
+    # room_code/guide_id is indexed as null, matching the upsert key
+    _create_index("note", [("user_id", 1), ("room_code", 1), ("guide_id", 1)], unique=True)
+    _create_index("studyguide", [("subject", 1), ("tags", 1), ("votes", -1)])
+    _create_index("studyguide", "title_lower")
+    # the unique (guide_id, version) index is built by migrate.py once duplicate
+    # history is cleaned up; until then keep the non-unique index for lookups
+    try:
+        migrated = GUIDE_VERSION_UNIQUE_INDEX in db["studyguideversion"].index_information()
+    except PyMongoError as e:
+        logger.warning("Could not inspect studyguideversion indexes: %s", e)
+        migrated = True
+    if not migrated:
+        _create_index("studyguideversion", [("guide_id", 1), ("version", -1)])
+    _create_index("event", [("user_id", 1), ("start", 1), ("end", 1)])
+    _create_index("task", [("user_id", 1), ("due", 1)])
+    _create_index("task", [("user_id", 1), ("completed", 1), ("priority", 1), ("due", 1)])
+    _create_index("preference", "user_id", unique=True)
+    # inverted index backing the /guides search box
+    _create_index(
+        "studyguide",
+        [("title", "text"), ("description", "text"), ("tags", "text")],
+        name="guide_text",
+    )
+
+# emit _id as a string server-side instead of patching each doc in Python
+STRINGIFY_ID = {"$addFields": {"_id": {"$toString": "$_id"}}}
+
 @app.get("/")
 def read_root():
     return {"message": "Classroom Platform Backend Running"}
@@ -47,21 +127,28 @@ class RoomCreate(BaseModel):
 
 @app.post("/rooms")
 def create_room(payload: RoomCreate):
-    # ensure uniqueness
-    existing = list(db["room"].find({"code": payload.code})) if db else []
-    if existing:
-        raise HTTPException(status_code=400, detail="Room code already exists")
     room = Room(**payload.model_dump())
     room.created_at = datetime.now(timezone.utc)
-    inserted_id = create_document("room", room)
+    # uniqueness is enforced by the unique index on code
+    try:
+        inserted_id = create_document("room", room)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Room code already exists")
     return {"id": inserted_id, "code": room.code}
 
 @app.get("/rooms/{code}")
-def get_room(code: str):
-    doc = db["room"].find_one({"code": code})
+def get_room(code: str, include_events: bool = True):
+    key = room_key(code, include_events)
+    cached = cache_get(key)
+    if cached is not None:
+        return ORJSONResponse(cached)
+    # clients polling broadcast state can skip the confusion history
+    projection = None if include_events else {"confusion_events": 0}
+    doc = db["room"].find_one({"code": code}, projection, max_time_ms=QUERY_TIMEOUT_MS)
     if not doc:
         raise HTTPException(status_code=404, detail="Room not found")
     doc["_id"] = str(doc["_id"])  # stringify
+    cache_set(key, doc, ROOM_TTL)
     return doc
 
 class BroadcastUpdate(BaseModel):
@@ -78,12 +165,20 @@ def update_broadcast(code: str, payload: BroadcastUpdate):
     res = db["room"].update_one({"code": code}, {"$set": updates})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Room not found")
+    cache_delete(*room_keys(code))
     return {"updated": True}
 
+MAX_CONFUSION_EVENTS = 100
+
 @app.post("/rooms/{code}/confused")
 def mark_confused(code: str):
     now = datetime.now(timezone.utc)
-    db["room"].update_one({"code": code}, {"$inc": {"confusion_count": 1}, "$push": {"confusion_events": now}})
+    # keep only the most recent events so room documents stay small
+    db["room"].update_one({"code": code}, {
+        "$inc": {"confusion_count": 1},
+        "$push": {"confusion_events": {"$each": [now], "$slice": -MAX_CONFUSION_EVENTS}},
+    })
+    cache_delete(*room_keys(code))
     return {"ok": True}
 
 # ---------- Anonymous Q&A ----------
@@ -94,7 +189,7 @@ class QuestionCreate(BaseModel):
 
 @app.post("/rooms/{code}/questions")
 def post_question(code: str, payload: QuestionCreate):
-    if not db["room"].find_one({"code": code}):
+    if not db["room"].count_documents({"code": code}, limit=1, maxTimeMS=QUERY_TIMEOUT_MS):
         raise HTTPException(status_code=404, detail="Room not found")
     q = Question(room_code=code, text=payload.text, author=payload.author, anonymous=payload.anonymous, created_at=datetime.now(timezone.utc))
     q_id = create_document("question", q)
@@ -102,21 +197,19 @@ def post_question(code: str, payload: QuestionCreate):
 
 @app.get("/rooms/{code}/questions")
 def list_questions(code: str):
-    items = db["question"].find({"room_code": code}).sort("created_at", -1)
-    out = []
-    for d in items:
-        d["_id"] = str(d["_id"])
-        out.append(d)
-    return out
+    return ORJSONResponse(list(db["question"].aggregate([
+        {"$match": {"room_code": code}},
+        {"$sort": {"created_at": -1}},
+        STRINGIFY_ID,
+    ], maxTimeMS=QUERY_TIMEOUT_MS)))
 
 class QuestionVote(BaseModel):
     up: bool = True
 
 @app.post("/questions/{qid}/vote")
 def vote_question(qid: str, payload: QuestionVote):
-    from bson import ObjectId
     inc = 1 if payload.up else -1
-    res = db["question"].update_one({"_id": ObjectId(qid)}, {"$inc": {"upvotes": inc}})
+    res = db["question"].update_one({"_id": _oid(qid)}, {"$inc": {"upvotes": inc}})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Question not found")
     return {"ok": True}
@@ -127,11 +220,10 @@ class QuestionAnswer(BaseModel):
 
 @app.post("/questions/{qid}/answer")
 def answer_question(qid: str, payload: QuestionAnswer):
-    from bson import ObjectId
     updates = {"answered": payload.answered}
     if payload.pinned is not None:
         updates["pinned"] = payload.pinned
-    res = db["question"].update_one({"_id": ObjectId(qid)}, {"$set": updates})
+    res = db["question"].update_one({"_id": _oid(qid)}, {"$set": updates})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Question not found")
     return {"ok": True}
@@ -152,13 +244,17 @@ def upsert_note(payload: NoteUpsert):
     if payload.guide_id:
         key["guide_id"] = payload.guide_id
     now = datetime.now(timezone.utc)
-    existing = db["note"].find_one(key)
-    if existing:
-        db["note"].update_one(key, {"$set": {"content": payload.content, "updated_at": now}})
-        return {"updated": True}
     n = Note(**payload.model_dump(), updated_at=now)
-    nid = create_document("note", n)
-    return {"created": True, "id": nid}
+    on_insert = n.model_dump(exclude={"content", "updated_at"})
+    on_insert["created_at"] = now
+    res = db["note"].update_one(
+        key,
+        {"$set": {"content": payload.content, "updated_at": now}, "$setOnInsert": on_insert},
+        upsert=True,
+    )
+    if res.upserted_id is None:
+        return {"updated": True}
+    return {"created": True, "id": str(res.upserted_id)}
 
 # ---------- Study Guides Hub ----------
 class GuideCreate(BaseModel):
@@ -174,72 +270,150 @@ class GuideCreate(BaseModel):
     content_markdown: str
     parent_id: Optional[str] = None
 
+MAX_GUIDE_BATCH = 100
+
+def _insert_guides(payloads: List[GuideCreate]) -> List[str]:
+    # one insert_many for the guides, one for their initial versions
+    now = datetime.now(timezone.utc)
+    guides = [
+        StudyGuide(**{**p.model_dump(), "created_at": now, "updated_at": now, "votes": 0, "tags": p.tags or [], "title_lower": p.title.lower()})
+        for p in payloads
+    ]
+    gids = create_documents("studyguide", guides)
+    versions = [
+        StudyGuideVersion(guide_id=gid, version=1, content_markdown=p.content_markdown, created_at=now)
+        for gid, p in zip(gids, payloads)
+    ]
+    create_documents("studyguideversion", versions)
+    cache_delete_pattern(GUIDE_SEARCH_PATTERN)
+    return gids
+
 @app.post("/guides")
 def create_guide(payload: GuideCreate):
-    now = datetime.now(timezone.utc)
-    guide = StudyGuide(**{**payload.model_dump(), "created_at": now, "updated_at": now, "votes": 0, "tags": payload.tags or []})
-    gid = create_document("studyguide", guide)
-    version = StudyGuideVersion(guide_id=gid, version=1, content_markdown=payload.content_markdown, created_at=now)
-    create_document("studyguideversion", version)
+    gid = _insert_guides([payload])[0]
     return {"id": gid}
 
+@app.post("/guides/batch")
+def create_guides(payloads: List[GuideCreate]):
+    if not payloads:
+        return {"ids": []}
+    if len(payloads) > MAX_GUIDE_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_GUIDE_BATCH} guides per batch")
+    return {"ids": _insert_guides(payloads)}
+
+AUTOCOMPLETE_MAX_LEN = 3
+
 @app.get("/guides")
 def list_guides(q: Optional[str] = None, subject: Optional[str] = None, tag: Optional[str] = None):
+    key = guide_search_key(q, subject, tag)
+    cached = cache_get(key)
+    if cached is not None:
+        return ORJSONResponse(cached)
+    # type-ahead queries are too short for word matching; match a case-sensitive
+    # ^-anchored prefix on the lowercased title, which the planner turns into a
+    # bounded range scan of the title_lower index
+    text_search = bool(q) and len(q) > AUTOCOMPLETE_MAX_LEN
     filt = {}
-    if q:
-        filt["title"] = {"$regex": q, "$options": "i"}
+    if text_search:
+        filt["$text"] = {"$search": q}
+    elif q:
+        filt["title_lower"] = {"$regex": "^" + re.escape(q.lower())}
     if subject:
         filt["subject"] = subject
     if tag:
         filt["tags"] = tag
-    cur = db["studyguide"].find(filt).sort("votes", -1).limit(50)
-    out = []
-    for d in cur:
-        d["_id"] = str(d["_id"])  # stringify
-        out.append(d)
-    return out
+    pipeline = [{"$match": filt}]
+    if text_search:
+        pipeline += [
+            {"$addFields": {"score": {"$meta": "textScore"}}},
+            {"$sort": {"score": -1, "votes": -1}},
+        ]
+    else:
+        pipeline.append({"$sort": {"votes": -1}})
+    # list views never render the body or description
+    pipeline += [{"$limit": 50}, {"$project": {"content_markdown": 0, "description": 0, "title_lower": 0}}, STRINGIFY_ID]
+    out = list(db["studyguide"].aggregate(pipeline, maxTimeMS=QUERY_TIMEOUT_MS))
+    cache_set(key, out, GUIDE_SEARCH_TTL)
+    return ORJSONResponse(out)
 
 class GuideVote(BaseModel):
     up: bool = True
 
 @app.post("/guides/{gid}/vote")
 def vote_guide(gid: str, payload: GuideVote):
-    from bson import ObjectId
     inc = 1 if payload.up else -1
-    res = db["studyguide"].update_one({"_id": ObjectId(gid)}, {"$inc": {"votes": inc}})
+    res = db["studyguide"].update_one({"_id": _oid(gid)}, {"$inc": {"votes": inc}})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Guide not found")
+    cache_delete(guide_key(gid))
+    cache_delete_pattern(GUIDE_SEARCH_PATTERN)
     return {"ok": True}
 
 class GuideUpdate(BaseModel):
     content_markdown: str
     changelog: Optional[str] = None
 
+def _bump_guide_version(oid: ObjectId, content_markdown: str, now: datetime):
+    # atomic version allocation; only matches guides that have a counter
+    return db["studyguide"].find_one_and_update(
+        {"_id": oid, "version_counter": {"$exists": True}},
+        {"$inc": {"version_counter": 1}, "$set": {"content_markdown": content_markdown, "updated_at": now}},
+        projection={"version_counter": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+
 @app.post("/guides/{gid}/update")
 def update_guide(gid: str, payload: GuideUpdate):
-    from bson import ObjectId
     now = datetime.now(timezone.utc)
-    # bump version
-    latest = db["studyguideversion"].find({"guide_id": gid}).sort("version", -1).limit(1)
-    latest_version = 1
-    for d in latest:
-        latest_version = d.get("version", 1)
-    create_document("studyguideversion", StudyGuideVersion(guide_id=gid, version=latest_version + 1, content_markdown=payload.content_markdown, changelog=payload.changelog, created_at=now))
-    db["studyguide"].update_one({"_id": ObjectId(gid)}, {"$set": {"content_markdown": payload.content_markdown, "updated_at": now}})
+    oid = _oid(gid)
+    d = _bump_guide_version(oid, payload.content_markdown, now)
+    if not d:
+        # guide missing, or created before version_counter existed; seed the
+        # counter from the stored history only if nobody has seeded it yet
+        latest = db["studyguideversion"].find_one({"guide_id": gid}, projection={"version": 1}, sort=[("version", -1)], max_time_ms=QUERY_TIMEOUT_MS)
+        db["studyguide"].update_one(
+            {"_id": oid, "version_counter": {"$exists": False}},
+            {"$set": {"version_counter": (latest or {}).get("version", 0)}},
+        )
+        d = _bump_guide_version(oid, payload.content_markdown, now)
+    if not d:
+        raise HTTPException(status_code=404, detail="Guide not found")
+    version = d["version_counter"]
+    create_document("studyguideversion", StudyGuideVersion(guide_id=gid, version=version, content_markdown=payload.content_markdown, changelog=payload.changelog, created_at=now))
+    cache_delete(guide_key(gid))
+    cache_delete_pattern(GUIDE_SEARCH_PATTERN)
     return {"ok": True}
 
+MAX_GUIDE_VERSIONS = 50
+
 @app.get("/guides/{gid}")
 def get_guide(gid: str):
-    from bson import ObjectId
-    d = db["studyguide"].find_one({"_id": ObjectId(gid)})
-    if not d:
+    cached = cache_get(guide_key(gid))
+    if cached is not None:
+        return ORJSONResponse(cached)
+    # guide plus its most recent versions in one round trip; the latest
+    # content already lives on the guide, so version bodies are left out
+    docs = list(db["studyguide"].aggregate([
+        {"$match": {"_id": _oid(gid)}},
+        {"$lookup": {
+            "from": "studyguideversion",
+            "let": {"g": {"$toString": "$_id"}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$guide_id", "$$g"]}}},
+                {"$sort": {"version": -1}},
+                {"$limit": MAX_GUIDE_VERSIONS},
+                {"$project": {"content_markdown": 0}},
+                STRINGIFY_ID,
+            ],
+            "as": "versions",
+        }},
+        {"$project": {"title_lower": 0}},
+        STRINGIFY_ID,
+    ], maxTimeMS=QUERY_TIMEOUT_MS))
+    if not docs:
         raise HTTPException(status_code=404, detail="Guide not found")
-    d["_id"] = str(d["_id"])  # stringify
-    versions = list(db["studyguideversion"].find({"guide_id": gid}).sort("version", -1))
-    for v in versions:
-        v["_id"] = str(v["_id"])  # stringify
-    d["versions"] = versions
-    return d
+    cache_set(guide_key(gid), docs[0], GUIDE_TTL)
+    return ORJSONResponse(docs[0])
 
 # ---------- Collections ----------
 class CollectionCreate(BaseModel):
@@ -256,8 +430,7 @@ def create_collection(payload: CollectionCreate):
 
 @app.get("/collections/{cid}")
 def get_collection(cid: str):
-    from bson import ObjectId
-    d = db["collection"].find_one({"_id": ObjectId(cid)})
+    d = db["collection"].find_one({"_id": _oid(cid)}, max_time_ms=QUERY_TIMEOUT_MS)
     if not d:
         raise HTTPException(status_code=404, detail="Collection not found")
     d["_id"] = str(d["_id"])  # stringify
@@ -285,12 +458,11 @@ def list_events(user_id: str, start: Optional[datetime] = None, end: Optional[da
     if start and end:
         filt["start"] = {"$gte": start}
         filt["end"] = {"$lte": end}
-    cur = db["event"].find(filt).sort("start", 1)
-    out = []
-    for d in cur:
-        d["_id"] = str(d["_id"])  # stringify
-        out.append(d)
-    return out
+    return ORJSONResponse(list(db["event"].aggregate([
+        {"$match": filt},
+        {"$sort": {"start": 1}},
+        STRINGIFY_ID,
+    ], maxTimeMS=QUERY_TIMEOUT_MS)))
 
 class TaskCreate(BaseModel):
     user_id: str
@@ -307,12 +479,11 @@ def create_task(payload: TaskCreate):
 
 @app.get("/tasks")
 def list_tasks(user_id: str):
-    cur = db["task"].find({"user_id": user_id}).sort("due", 1)
-    out = []
-    for d in cur:
-        d["_id"] = str(d["_id"])  # stringify
-        out.append(d)
-    return out
+    return ORJSONResponse(list(db["task"].aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"due": 1}},
+        STRINGIFY_ID,
+    ], maxTimeMS=QUERY_TIMEOUT_MS)))
 
 class PrefUpsert(BaseModel):
     user_id: str
@@ -326,63 +497,122 @@ class PrefUpsert(BaseModel):
 @app.post("/preferences")
 def upsert_preferences(payload: PrefUpsert):
     key = {"user_id": payload.user_id}
-    existing = db["preference"].find_one(key)
+    now = datetime.now(timezone.utc)
     updates = {k: v for k, v in payload.model_dump().items() if v is not None}
-    if existing:
-        db["preference"].update_one(key, {"$set": updates})
+    updates["updated_at"] = now
+    # defaults only for fields the caller did not send; $set and $setOnInsert must not overlap
+    defaults = Preference(user_id=payload.user_id).model_dump()
+    on_insert = {k: v for k, v in defaults.items() if k not in updates}
+    on_insert["created_at"] = now
+    res = db["preference"].update_one(key, {"$set": updates, "$setOnInsert": on_insert}, upsert=True)
+    if res.upserted_id is None:
         return {"updated": True}
-    pref = Preference(**{
-        "user_id": payload.user_id,
-        "focus_period_minutes": payload.focus_period_minutes or 50,
-        "short_session_minutes": payload.short_session_minutes or 25,
-        "preferred_time_of_day": payload.preferred_time_of_day,
-        "availability_weekdays": payload.availability_weekdays or [0,1,2,3,4],
-        "earliest_hour": payload.earliest_hour or 8,
-        "latest_hour": payload.latest_hour or 22,
-    })
-    pid = create_document("preference", pref)
-    return {"created": True, "id": pid}
+    return {"created": True, "id": str(res.upserted_id)}
 
 # ---------- Time Manager Suggestions ----------
 
-def _within_prefs(dt: datetime, pref: Preference) -> bool:
-    w = dt.weekday()
-    if pref.availability_weekdays and w not in pref.availability_weekdays:
-        return False
-    if dt.hour < (pref.earliest_hour or 0) or dt.hour >= (pref.latest_hour or 24):
-        return False
-    if pref.preferred_time_of_day == "morning" and not (5 <= dt.hour < 12):
-        return False
-    if pref.preferred_time_of_day == "afternoon" and not (12 <= dt.hour < 17):
-        return False
-    if pref.preferred_time_of_day == "evening" and not (17 <= dt.hour < 22):
-        return False
-    if pref.preferred_time_of_day == "night" and not (22 <= dt.hour or dt.hour < 5):
-        return False
-    return True
+SLOT = timedelta(minutes=30)
+
+# hour ranges [lo, hi) for each preferred_time_of_day; "night" wraps midnight
+TIME_OF_DAY_HOURS = {
+    "morning": (5, 12),
+    "afternoon": (12, 17),
+    "evening": (17, 22),
+    "night": (22, 5),
+}
+
+SLOTS_PER_DAY = 48
+
+@lru_cache(maxsize=1024)
+def _week_slots(weekdays: Tuple[int, ...], earliest: int, latest: int, time_of_day: Optional[str]) -> Tuple[Tuple[timedelta, ...], ...]:
+    """Allowed slot offsets from midnight for each weekday (0=Mon), in order."""
+    slot = np.arange(7 * SLOTS_PER_DAY)
+    day = slot // SLOTS_PER_DAY
+    hours = (slot % SLOTS_PER_DAY) // 2
+
+    mask = (hours >= (earliest or 0)) & (hours < (latest or 24))
+    if weekdays:
+        mask &= np.isin(day, weekdays)
+    if time_of_day:
+        lo, hi = TIME_OF_DAY_HOURS[time_of_day]
+        mask &= ((hours >= lo) & (hours < hi)) if lo < hi else ((hours >= lo) | (hours < hi))
+
+    mask = mask.reshape(7, SLOTS_PER_DAY)
+    return tuple(tuple(idx * SLOT for idx in np.flatnonzero(mask[w]).tolist()) for w in range(7))
+
+def _allowed_slots(start: datetime, horizon: datetime, pref: Preference) -> Iterator[datetime]:
+    """Yield 30 minute slot starts in [start, horizon) that satisfy the user's preferences, in order."""
+    # most users keep the default preferences, so the week's offsets are nearly
+    # always cached and each slot costs one addition
+    week = _week_slots(
+        tuple(sorted(set(pref.availability_weekdays or []))),
+        pref.earliest_hour,
+        pref.latest_hour,
+        pref.preferred_time_of_day,
+    )
+    day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < horizon:
+        for offset in week[day.weekday()]:
+            slot = day + offset
+            if slot < start:
+                continue
+            if slot >= horizon:
+                return
+            yield slot
+        day += timedelta(days=1)
+
+def _as_utc(dt: datetime) -> datetime:
+    # pymongo hands back naive datetimes that are implicitly UTC
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+def _merge_intervals(intervals) -> Tuple[List[datetime], List[datetime]]:
+    """Sort and coalesce overlapping intervals into parallel start/end lists."""
+    starts: List[datetime] = []
+    ends: List[datetime] = []
+    for s, e in sorted(intervals):
+        if ends and s <= ends[-1]:
+            ends[-1] = max(ends[-1], e)
+        else:
+            starts.append(s)
+            ends.append(e)
+    return starts, ends
+
+def _conflict_end(starts: List[datetime], ends: List[datetime], start: datetime, end: datetime) -> Optional[datetime]:
+    """Return the end of the busy interval overlapping [start, end), or None if free."""
+    i = bisect_right(starts, start) - 1
+    if i >= 0 and ends[i] > start:
+        return ends[i]
+    if i + 1 < len(starts) and starts[i + 1] < end:
+        return ends[i + 1]
+    return None
 
 @app.post("/suggestions")
 def generate_suggestions(req: SuggestionRequest):
     # pull data
-    pref_doc = db["preference"].find_one({"user_id": req.user_id})
+    pref_doc = db["preference"].find_one({"user_id": req.user_id}, max_time_ms=QUERY_TIMEOUT_MS)
     pref = Preference(**pref_doc) if pref_doc else Preference(user_id=req.user_id)
 
-    tasks = list(db["task"].find({"user_id": req.user_id}))
-    events = list(db["event"].find({"user_id": req.user_id}))
-
     now = datetime.now(timezone.utc)
     horizon = now + timedelta(days=req.horizon_days)
+    window_start = now.replace(minute=0, second=0, microsecond=0)
+    window_end = horizon + timedelta(minutes=pref.focus_period_minutes)
+
+    # exclusions are written as positive equality ($ne/$nin can't be bounded
+    # by the index); every task is inserted with completed=False
+    tasks = list(db["task"].find(
+        {"user_id": req.user_id, "completed": False},
+        projection={"title": 1, "priority": 1, "due": 1},
+        max_time_ms=QUERY_TIMEOUT_MS,
+    ))
+    # only events that can overlap a candidate slot
+    events = list(db["event"].find(
+        {"user_id": req.user_id, "end": {"$gt": window_start}, "start": {"$lt": window_end}},
+        projection={"_id": 0, "start": 1, "end": 1},
+        max_time_ms=QUERY_TIMEOUT_MS,
+    ))
 
-    # build busy intervals
-    busy = []
-    for e in events:
-        busy.append((e["start"], e["end"]))
-
-    def is_free(start: datetime, end: datetime) -> bool:
-        for bs, be in busy:
-            if not (end <= bs or start >= be):
-                return False
-        return True
+    # build busy intervals, sorted and disjoint so lookups can bisect
+    busy_starts, busy_ends = _merge_intervals((_as_utc(e["start"]), _as_utc(e["end"])) for e in events)
 
     # prioritize tasks: urgent first, then due date
     def priority_value(p: str) -> int:
@@ -391,30 +621,39 @@ def generate_suggestions(req: SuggestionRequest):
 
     tasks.sort(key=lambda t: (
         -priority_value(t.get("priority")),
-        t.get("due") or now + timedelta(days=365)
+        _as_utc(t["due"]) if t.get("due") else now + timedelta(days=365)
     ))
 
     suggestions: List[Suggestion] = []
 
-    # loop days and hours
-    cursor = now.replace(minute=0, second=0, microsecond=0)
-    while cursor < horizon and len(suggestions) < 20:
+    # walk the preference-filtered slots; they are generated lazily, so the
+    # walk stops as soon as 20 suggestions are found
+    blocked_until = None
+    for cursor in _allowed_slots(window_start, horizon, pref):
+        if len(suggestions) >= 20:
+            break
+        if blocked_until is not None and cursor < blocked_until:
+            continue
         end_slot = cursor + timedelta(minutes=pref.focus_period_minutes)
-        if _within_prefs(cursor, pref) and is_free(cursor, end_slot):
-            # find a task that benefits from this slot
-            picked = None
-            for t in tasks:
-                picked = t
-                break
-            title = f"Study Session"
-            related_task_id = None
-            if picked:
-                related_task_id = str(picked.get("_id"))
-                title = f"Work on: {picked.get('title')}"
-            suggestions.append(Suggestion(user_id=req.user_id, title=title, start=cursor, end=end_slot, related_task_id=related_task_id))
-            # mark this interval busy
-            busy.append((cursor, end_slot))
-        cursor += timedelta(minutes=30)
+        blocked_until = _conflict_end(busy_starts, busy_ends, cursor, end_slot)
+        if blocked_until is not None:
+            # later slots inside the busy block are skipped without a lookup
+            continue
+        # find a task that benefits from this slot
+        picked = None
+        for t in tasks:
+            picked = t
+            break
+        title = f"Study Session"
+        related_task_id = None
+        if picked:
+            related_task_id = str(picked.get("_id"))
+            title = f"Work on: {picked.get('title')}"
+        suggestions.append(Suggestion(user_id=req.user_id, title=title, start=cursor, end=end_slot, related_task_id=related_task_id))
+        # mark this interval busy
+        k = bisect_left(busy_starts, cursor)
+        busy_starts.insert(k, cursor)
+        busy_ends.insert(k, end_slot)
 
     # return serialized
     out = []
@@ -456,7 +695,6 @@ def test_database():
             response["database"] = "⚠️  Available but not initialized"
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
-    import os
     response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
     response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
     return response
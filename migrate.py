@@ -0,0 +1,68 @@
+"""
+Database Migrations
+
+One-off data and index migrations that are unsafe to run in the app's
+startup hook. Run them offline, with the API stopped, against the database
+configured by DATABASE_URL and DATABASE_NAME:
+
+    python migrate.py
+"""
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from database import db
+
+# Unique (guide_id, version) index on studyguideversion. It uses an ascending
+# version key so it can be built alongside the older non-unique
+# (guide_id, version DESC) index, which is dropped only once it exists.
+GUIDE_VERSION_UNIQUE_INDEX = "guide_id_1_version_1"
+GUIDE_VERSION_LEGACY_INDEX = "guide_id_1_version_-1"
+
+def renumber_duplicate_guide_versions():
+    """Move duplicate (guide_id, version) rows to fresh version numbers"""
+    versions = db["studyguideversion"]
+    duplicates = versions.aggregate([
+        {"$group": {"_id": {"guide_id": "$guide_id", "version": "$version"}, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+
+    moved = 0
+    for dup in duplicates:
+        gid = dup["_id"]["guide_id"]
+        latest = versions.find_one({"guide_id": gid}, projection={"version": 1}, sort=[("version", -1)])
+        next_version = latest["version"]
+        # the oldest row keeps its number; the others are appended after the history
+        for _id in sorted(dup["ids"])[1:]:
+            next_version += 1
+            versions.update_one({"_id": _id}, {"$set": {"version": next_version}})
+            moved += 1
+        if ObjectId.is_valid(gid):
+            db["studyguide"].update_one({"_id": ObjectId(gid)}, {"$max": {"version_counter": next_version}})
+    return moved
+
+def build_unique_guide_version_index():
+    """Build the unique version index, then drop the non-unique one it replaces"""
+    versions = db["studyguideversion"]
+    versions.create_index([("guide_id", 1), ("version", 1)], unique=True, name=GUIDE_VERSION_UNIQUE_INDEX)
+    if GUIDE_VERSION_LEGACY_INDEX in versions.index_information():
+        versions.drop_index(GUIDE_VERSION_LEGACY_INDEX)
+
+def backfill_guide_title_lower():
+    """Set title_lower on guides created before prefix search used it"""
+    guides = db["studyguide"]
+    ops = [
+        UpdateOne({"_id": g["_id"]}, {"$set": {"title_lower": (g.get("title") or "").lower()}})
+        for g in guides.find({"title_lower": {"$exists": False}}, projection={"title": 1})
+    ]
+    if ops:
+        guides.bulk_write(ops, ordered=False)
+    return len(ops)
+
+if __name__ == "__main__":
+    if db is None:
+        raise SystemExit("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    print(f"Renumbered {renumber_duplicate_guide_versions()} duplicate guide versions")
+    build_unique_guide_version_index()
+    print(f"Built {GUIDE_VERSION_UNIQUE_INDEX} on studyguideversion")
+    print(f"Backfilled title_lower on {backfill_guide_title_lower()} guides")
@@ -57,6 +57,7 @@ class Note(BaseModel):
 # Study Guides
 class StudyGuide(BaseModel):
     title: str
+    title_lower: Optional[str] = Field(None, description="Lowercased title for prefix search")
     subject: Optional[str] = None
     difficulty: Optional[Literal["easy", "medium", "hard"]] = None
     exam_type: Optional[str] = None
@@ -69,6 +70,7 @@ class StudyGuide(BaseModel):
     content_markdown: str
     parent_id: Optional[str] = None  # for forks
     votes: int = 0
+    version_counter: int = Field(1, description="Latest version number, bumped atomically on update")
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
 
@@ -115,7 +117,7 @@ class Preference(BaseModel):
 
 class SuggestionRequest(BaseModel):
     user_id: str
-    horizon_days: int = 7
+    horizon_days: int = Field(7, ge=1, le=60, description="How many days ahead to plan")
 
 class Suggestion(BaseModel):
     user_id: str